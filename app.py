@@ -3,9 +3,16 @@ import streamlit as st
 import numpy as np
 import folium
 import pickle
-from streamlit_folium import st_folium
-from folium.plugins import HeatMap
-from sparse_lgcp import SparseLGCP
+import json
+import os
+import tempfile
+from folium.plugins import HeatMap, FastMarkerCluster
+from folium.template import Template
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
 
 st.set_page_config(
 	page_title="Home",
@@ -18,12 +25,202 @@ st.set_page_config(
 	}
 )
 
+rng = np.random.default_rng()
+NUM_PRODUCTIVITY_POINTS = 40
+# Above this many prediction grid points Leaflet's canvas renderer gets sluggish, so switch to deck.gl (WebGL)
+WEBGL_HEATMAP_THRESHOLD = 5000
+HEATMAP_GRADIENT = {
+	0.0: '#ffffff',
+	0.2: '#2c7bb6',
+	0.4: '#abd9e9',
+	0.6: '#ffffbf',
+	0.8: '#fdae61',
+	1.0: '#d7191c'
+}
+
+# Leaflet-side marker factory for FastMarkerCluster; rows are [lat, lon, idx]
+SHARK_MARKER_CALLBACK = """
+function (row) {
+	var marker = L.marker(new L.LatLng(row[0], row[1]));
+	marker.bindPopup('Shark #' + row[2] + ' (' + row[0].toFixed(2) + ', ' + row[1].toFixed(2) + ')');
+	marker.bindTooltip('Shark #' + row[2]);
+	return marker;
+}
+"""
+
+def dumps_json(obj):
+	if orjson is not None:
+		return orjson.dumps(obj).decode()
+	return json.dumps(obj)
+
+def build_coords(grid_lat, grid_lon, lat_min, lat_max, lon_min, lon_max, t_last, out):
+	# Fill a preallocated (N, 3) buffer with normalized [lon, lat, t] rows in lat-major grid order
+	inv_lat = 1.0 / (lat_max - lat_min)
+	inv_lon = 1.0 / (lon_max - lon_min)
+	out_grid = out.reshape(grid_lat.size, grid_lon.size, 3)
+	out_grid[:, :, 0] = (grid_lon - lon_min) * inv_lon
+	out_grid[:, :, 1] = ((grid_lat - lat_min) * inv_lat)[:, None]
+	out_grid[:, :, 2] = t_last
+	return out
+
+class PrecomputedHeatMap(HeatMap):
+	"""HeatMap that embeds an already serialized JSON array instead of templating each point."""
+	_template = Template("""
+		{% macro script(this, kwargs) %}
+			var {{ this.get_name() }} = L.heatLayer(
+				{{ this.data_json }},
+				{{ this.options|tojavascript }}
+			);
+		{% endmacro %}
+	""")
+
+	def __init__(self, data_json, **kwargs):
+		super().__init__([], **kwargs)
+		self.data_json = data_json
+
+# --- Cached loaders shared across reruns and sessions ---
+@st.cache_resource
+def load_lgcp_model(path="models/sparse_lgcp.pkl"):
+	# Imported here so reruns that don't predict never touch the model package
+	from sparse_lgcp import SparseLGCP  # noqa: F401 - the pickle references this class
+	with open(path, "rb") as f:
+		return pickle.load(f)
+
+@st.cache_data
+def load_shark_locations(path, mtime):
+	# mtime is only part of the cache key so an updated CSV is re-read
+	import pandas as pd
+	try:
+		df = pd.read_csv(path, engine="pyarrow", usecols=['latitude', 'longitude'])
+	except KeyError:
+		# pyarrow reports missing usecols columns as ArrowKeyError
+		return None
+	return df[['latitude', 'longitude']].to_numpy()
+
+# --- Cached map rendering ---
+@st.cache_data(max_entries=32)
+def build_map_html(pred_heat_json, shark_locs, heatmap_opacity, heatmap_radius, center, zoom):
+	m = folium.Map(
+		location=center,
+		zoom_start=zoom,
+		control_scale=True,
+		tiles='https://services.arcgisonline.com/ArcGIS/rest/services/Ocean/World_Ocean_Base/MapServer/tile/{z}/{y}/{x}',
+		attr='Tiles &copy; Esri &mdash; Source: Esri, GEBCO, NOAA, National Geographic, DeLorme, NAVTEQ, and other contributors',
+		max_zoom=10,
+		no_wrap=True
+	)
+	if pred_heat_json is not None:
+		PrecomputedHeatMap(
+			pred_heat_json,
+			min_opacity=0.2,
+			max_opacity=heatmap_opacity,
+			radius=heatmap_radius,
+			blur=22,
+			gradient=HEATMAP_GRADIENT,
+			name='Model Prediction'
+		).add_to(m)
+	# Add clustered markers for the last 100 shark detections in a single JS payload
+	if shark_locs is not None and len(shark_locs) > 0:
+		marker_rows = np.column_stack([shark_locs, np.arange(1, len(shark_locs) + 1)]).tolist()
+		FastMarkerCluster(
+			data=marker_rows,
+			callback=SHARK_MARKER_CALLBACK,
+			name='Sharks'
+		).add_to(m)
+	return m.get_root().render()
+
+@st.cache_data(max_entries=4)
+def build_deck_frames(pred_heat_json, _pred_heat, shark_locs):
+	# Keyed on the serialized payload; _pred_heat carries the same points without being hashed
+	import pandas as pd
+	heat_df = pd.DataFrame(_pred_heat, columns=['lat', 'lon', 'weight'])
+	shark_df = None
+	if shark_locs is not None and len(shark_locs) > 0:
+		shark_df = pd.DataFrame(shark_locs, columns=['lat', 'lon'])
+		# Same text as the folium marker popups
+		shark_df['label'] = [f"Shark #{idx} ({lat:.2f}, {lon:.2f})" for idx, (lat, lon) in enumerate(shark_locs, 1)]
+	return heat_df, shark_df
+
+def build_deck(pred_heat_json, pred_heat, shark_locs, heatmap_opacity, heatmap_radius, center, zoom):
+	import pydeck as pdk
+	heat_df, shark_df = build_deck_frames(pred_heat_json, pred_heat, shark_locs)
+	color_range = [
+		[int(color[i:i + 2], 16) for i in (1, 3, 5)]
+		for _, color in sorted(HEATMAP_GRADIENT.items())
+	]
+	layers = [
+		pdk.Layer(
+			"HeatmapLayer",
+			data=heat_df,
+			get_position='[lon, lat]',
+			get_weight='weight',
+			# Bare strings become deck.gl expressions; this one must stay a literal
+			aggregation=pdk.types.String('MEAN'),
+			radius_pixels=heatmap_radius,
+			opacity=heatmap_opacity,
+			color_range=color_range
+		)
+	]
+	if shark_df is not None:
+		layers.append(pdk.Layer(
+			"ScatterplotLayer",
+			data=shark_df,
+			get_position='[lon, lat]',
+			get_fill_color=[215, 25, 28],
+			radius_min_pixels=4,
+			pickable=True
+		))
+	return pdk.Deck(
+		layers=layers,
+		initial_view_state=pdk.ViewState(latitude=center[0], longitude=center[1], zoom=zoom),
+		tooltip={'text': '{label}'}
+	)
+
+# --- On-disk cache of the last computed payloads, survives server restarts ---
+CACHE_DIR = 'cache'
+PRED_CACHE_PATH = os.path.join(CACHE_DIR, 'last_pred.parquet')
+POINTS_CACHE_PATH = os.path.join(CACHE_DIR, 'last_points.npz')
+
+def _replace_atomically(path, write):
+	# All sessions share these files, so readers must never see a partially written one
+	with tempfile.NamedTemporaryFile(dir=CACHE_DIR, suffix='.tmp', delete=False) as f:
+		try:
+			write(f)
+		except Exception:
+			f.close()
+			os.remove(f.name)
+			raise
+	os.replace(f.name, path)
+
+def save_payloads(settings, pred_lat, pred_lon, pred_rate, shark_locs, productivity_points):
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+	os.makedirs(CACHE_DIR, exist_ok=True)
+	table = pa.Table.from_arrays([pa.array(pred_lat), pa.array(pred_lon), pa.array(pred_rate)], names=['lat', 'lon', 'rate'])
+	# The settings travel with the Parquet file so a restore can tell whether it still applies
+	table = table.replace_schema_metadata({'settings': json.dumps(settings)})
+	_replace_atomically(POINTS_CACHE_PATH, lambda f: np.savez(f, shark_locs=shark_locs, productivity_points=np.asarray(productivity_points)))
+	# The Parquet file goes last: once its settings are visible, the matching NPZ is already in place
+	_replace_atomically(PRED_CACHE_PATH, lambda f: pq.write_table(table, f))
+
+def load_payloads(settings):
+	# Returns None unless the last saved payloads were computed with exactly these settings.
+	# A fresh session always starts on the default sliders, so in practice only a payload from a
+	# Refresh with default settings can be restored; any other Refresh overwrites it.
+	import pyarrow.parquet as pq
+	if not os.path.exists(PRED_CACHE_PATH) or not os.path.exists(POINTS_CACHE_PATH):
+		return None
+	table = pq.read_table(PRED_CACHE_PATH)
+	metadata = table.schema.metadata or {}
+	if json.loads(metadata.get(b'settings', b'null')) != settings:
+		return None
+	pred_heat = np.column_stack([table.column(name).to_numpy() for name in ('lat', 'lon', 'rate')]).tolist()
+	with np.load(POINTS_CACHE_PATH) as points:
+		return pred_heat, points['shark_locs'], points['productivity_points'].tolist()
+
 # --- Session-state-based map/data caching ---
-if 'productivity_points' not in st.session_state or 'shark_locs' not in st.session_state or 'pred_heat' not in st.session_state or 'last_refresh' not in st.session_state:
-	st.session_state['productivity_points'] = None
-	st.session_state['shark_locs'] = None
-	st.session_state['pred_heat'] = None
-	st.session_state['last_refresh'] = 0
+for key in ('productivity_points', 'shark_locs', 'pred_heat', 'pred_heat_json', 'pred_grid_size'):
+	st.session_state.setdefault(key, None)
 
 # --- Sidebar user controls for model and map ---
 with st.sidebar:
@@ -31,6 +228,8 @@ with st.sidebar:
 	num_samples = st.slider("MC samples for prediction", min_value=100, max_value=2000, value=500, step=100)
 	grid_lat_res = st.slider("Prediction grid latitude points", min_value=10, max_value=100, value=40, step=5)
 	grid_lon_res = st.slider("Prediction grid longitude points", min_value=20, max_value=200, value=80, step=10)
+	heatmap_cutoff = st.slider("Heatmap rate cutoff percentile", min_value=0, max_value=90, value=50, step=5, help='Grid points below this rate percentile are not sent to the map; applied on the next Refresh')
+	# Style-only controls: changing these only re-renders the cached map, never reruns the model
 	heatmap_opacity = st.slider("Heatmap max opacity", min_value=0.1, max_value=1.0, value=0.6, step=0.05)
 	heatmap_radius = st.slider("Heatmap radius", min_value=5, max_value=50, value=18, step=1)
 
@@ -38,35 +237,54 @@ col1, col2 = st.columns([1, 8])
 with col1:
 	refresh = st.button('Refresh Map', help='Regenerate shark locations and productivity')
 
+ds_name = 'sharks_spatial_filtered.csv'
+ds_path = './data'
+csv_path = os.path.join(ds_path, ds_name)
+payload_settings = {
+	'num_samples': num_samples,
+	'grid_lat_res': grid_lat_res,
+	'grid_lon_res': grid_lon_res,
+	'cutoff': heatmap_cutoff,
+	'csv_mtime': os.path.getmtime(csv_path) if os.path.exists(csv_path) else None
+}
+if not refresh and st.session_state['productivity_points'] is None:
+	# Fresh session: reuse the last prediction if it matches these settings and the current CSV
+	try:
+		restored = load_payloads(payload_settings)
+		if restored is not None:
+			pred_heat, shark_locs, productivity_points = restored
+			st.session_state['pred_heat'] = pred_heat
+			st.session_state['pred_heat_json'] = dumps_json(pred_heat)
+			st.session_state['pred_grid_size'] = grid_lat_res * grid_lon_res
+			st.session_state['shark_locs'] = shark_locs
+			st.session_state['productivity_points'] = productivity_points
+	except Exception as e:
+		st.warning(f"Could not restore cached predictions: {e}")
+
 if refresh or st.session_state['productivity_points'] is None:
 	# Regenerate data
-	lats = np.random.uniform(-60, 60, 40)
-	lons = np.random.uniform(-180, 180, 40)
-	productivity = np.clip(0.7 * np.cos(np.radians(lats)) + 0.1 * np.random.randn(40), 0, None)
-	st.session_state['productivity_points'] = list(zip(lats, lons, productivity))
+	coords = rng.uniform([-60, -180], [60, 180], size=(NUM_PRODUCTIVITY_POINTS, 2))
+	lats, lons = coords[:, 0], coords[:, 1]
+	productivity = np.clip(0.7 * np.cos(np.deg2rad(lats)) + 0.1 * rng.standard_normal(NUM_PRODUCTIVITY_POINTS), 0, None)
+	st.session_state['productivity_points'] = np.column_stack([lats, lons, productivity]).tolist()
 	# Load shark locations from dataset with error handling
-	import pandas as pd
-	import os
-	ds_name = 'sharks_spatial_filtered.csv'
-	ds_path = './data'
 	try:
-		df = pd.read_csv(os.path.join(ds_path, ds_name))
-		if 'latitude' in df.columns and 'longitude' in df.columns:
-			sharks = list(zip(df['latitude'], df['longitude']))
-			if len(sharks) > 1000:
-				st.warning(f"Dataset has {len(sharks)} shark locations. Showing only the first 1000 for performance.")
-				sharks = sharks[:1000]
-			st.session_state['shark_locs'] = sharks
+		shark_arr = load_shark_locations(csv_path, os.path.getmtime(csv_path))
+		if shark_arr is not None:
+			if len(shark_arr) > 1000:
+				st.warning(f"Dataset has {len(shark_arr)} shark locations. Showing only the first 1000 for performance.")
+				shark_arr = shark_arr[:1000]
+			# Only the last 100 detections are drawn as markers, so only keep those
+			st.session_state['shark_locs'] = shark_arr[-100:]
 		else:
-			st.session_state['shark_locs'] = []
+			st.session_state['shark_locs'] = np.empty((0, 2))
 			st.warning("CSV file does not contain 'latitude' and 'longitude' columns.")
 	except Exception as e:
-		st.session_state['shark_locs'] = []
+		st.session_state['shark_locs'] = np.empty((0, 2))
 		st.warning(f"Could not load shark locations: {e}")
 	# Model prediction
 	try:
-		with open("models/sparse_lgcp.pkl", "rb") as f:
-			model = pickle.load(f)
+		model = load_lgcp_model()
 		# Use the same bounding box as model training for normalization
 		lat_min, lat_max = 8, 55
 		lon_min, lon_max = -98, -25
@@ -74,89 +292,82 @@ if refresh or st.session_state['productivity_points'] is None:
 		grid_lat = np.linspace(lat_min, lat_max, grid_lat_res)
 		grid_lon = np.linspace(lon_min, lon_max, grid_lon_res)
 		t_last = 1.0
-		grid_points = np.array([[lat, lon, t_last] for lat in grid_lat for lon in grid_lon])
-		# Normalize using the same logic as model training
-		lat_norm = (grid_points[:, 0] - lat_min) / (lat_max - lat_min)
-		lon_norm = (grid_points[:, 1] - lon_min) / (lon_max - lon_min)
-		coords_pred = np.column_stack([lon_norm, lat_norm, np.full_like(lat_norm, t_last)])
+		grid_lat_mesh, grid_lon_mesh = np.meshgrid(grid_lat, grid_lon, indexing='ij')
+		lat_flat = grid_lat_mesh.ravel()
+		lon_flat = grid_lon_mesh.ravel()
+		# Normalize using the same logic as model training; float32 halves memory traffic during MC sampling
+		coords_pred = build_coords(
+			grid_lat, grid_lon,
+			float(lat_min), float(lat_max), float(lon_min), float(lon_max), t_last,
+			np.empty((lat_flat.size, 3), dtype=np.float32)
+		)
 		rate_mean, _, _ = model.predict_rate(coords_pred, num_samples=num_samples, alpha_regularization=True)
-		pred_heat = [
-			[lat, lon, float(rate)]
-			for (lat, lon, _), rate in zip(grid_points, rate_mean)
-		]
+		rate_mean = np.asarray(rate_mean, dtype=float)
+		# PrecomputedHeatMap bypasses folium's NaN check and the percentile cutoff breaks on NaN
+		if not np.isfinite(rate_mean).all():
+			raise ValueError("predicted rates contain NaN or infinite values.")
+		# Low-rate points are smeared away by the heatmap blur anyway; dropping them shrinks the browser payload
+		keep = rate_mean >= np.percentile(rate_mean, heatmap_cutoff)
+		pred_heat = np.column_stack([lat_flat[keep], lon_flat[keep], rate_mean[keep]]).tolist()
 		st.session_state['pred_heat'] = pred_heat
-		st.session_state['last_refresh'] += 1
+		# Serialize once here so reruns reuse the JSON instead of re-templating every point
+		st.session_state['pred_heat_json'] = dumps_json(pred_heat)
+		st.session_state['pred_grid_size'] = lat_flat.size
+		try:
+			save_payloads(
+				payload_settings,
+				lat_flat[keep], lon_flat[keep], rate_mean[keep],
+				st.session_state['shark_locs'], st.session_state['productivity_points']
+			)
+		except Exception as e:
+			st.warning(f"Could not cache predictions to disk: {e}")
 		# Debug: show summary stats for prediction
-		rates = [r[2] for r in pred_heat]
-		st.info(f"Prediction stats: min={np.min(rates):.3g}, max={np.max(rates):.3g}, mean={np.mean(rates):.3g}, nonzero={np.count_nonzero(rates)} / {len(rates)}")
+		st.info(f"Prediction stats: min={rate_mean.min():.3g}, max={rate_mean.max():.3g}, mean={rate_mean.mean():.3g}, nonzero={np.count_nonzero(rate_mean)} / {rate_mean.size}")
 		st.success("Model prediction overlay added to the map.")
 	except Exception as e:
 		st.session_state['pred_heat'] = None
+		st.session_state['pred_heat_json'] = None
+		st.session_state['pred_grid_size'] = None
 		st.warning(f"Model prediction not available: {e}")
 
 # --- Create map with blue sea style ---
 center = st.session_state.get('map_center', [0, 0])
 if isinstance(center, dict):
 	center = [center.get('lat', 0), center.get('lng', 0)]
-m = folium.Map(
-	location=center,
-	zoom_start=st.session_state.get('map_zoom', 2),
-	control_scale=True,
-	tiles='https://services.arcgisonline.com/ArcGIS/rest/services/Ocean/World_Ocean_Base/MapServer/tile/{z}/{y}/{x}',
-	attr='Tiles &copy; Esri &mdash; Source: Esri, GEBCO, NOAA, National Geographic, DeLorme, NAVTEQ, and other contributors',
-	max_zoom=10,
-	no_wrap=True
-)
 
 st.markdown("### Shark Foraging Prediction (Model Output)")
-if st.session_state['pred_heat'] is not None:
-	HeatMap(
-		st.session_state['pred_heat'],
-		min_opacity=0.2,
-		max_opacity=heatmap_opacity,
-		radius=heatmap_radius,
-		blur=22,
-		gradient={
-			0.0: '#ffffff',
-			0.2: '#2c7bb6',
-			0.4: '#abd9e9',
-			0.6: '#ffffbf',
-			0.8: '#fdae61',
-			1.0: '#d7191c'
-		},
-		name=f'Model Prediction_{st.session_state["last_refresh"]}'
-	).add_to(m)
-
-# Add regular markers for the last 100 shark detections
-if st.session_state['shark_locs']:
-	last_sharks = st.session_state['shark_locs'][-100:]
-	for idx, (lat, lon) in enumerate(last_sharks, 1):
-		folium.Marker(
-			location=[lat, lon],
-			popup=f"Shark #{idx} ({lat:.2f}, {lon:.2f})",
-			tooltip=f"Shark #{idx}"
-		).add_to(m)
-else:
+if st.session_state['shark_locs'] is None or len(st.session_state['shark_locs']) == 0:
 	st.warning("No shark locations to display on the map.")
 
-# Display the map in Streamlit with better interactivity
-center = [0, 0]
-zoom = 2
-feature_group = None
-for fg in m._children.values():
-	if isinstance(fg, folium.map.FeatureGroup):
-		feature_group = fg
-		break
-
-st_folium(
-	m,
-	center=center,
-	zoom=zoom,
-	feature_group_to_add=feature_group,
-	key=f"folium_map_{st.session_state['last_refresh']}",
-	use_container_width=True
-)
+# Display the map; large prediction grids are drawn on the GPU, otherwise the rendered
+# folium HTML is reused until its data or style inputs change. The switch depends only on the
+# grid the shown prediction was computed on, so the cutoff slider never flips renderers.
+if st.session_state['pred_heat'] is not None and st.session_state['pred_grid_size'] > WEBGL_HEATMAP_THRESHOLD:
+	st.caption(f"The prediction grid has {st.session_state['pred_grid_size']} points, so the map is drawn with WebGL (deck.gl) on the default basemap. Hover a red dot for shark details.")
+	st.pydeck_chart(
+		build_deck(
+			st.session_state['pred_heat_json'],
+			st.session_state['pred_heat'],
+			st.session_state['shark_locs'],
+			heatmap_opacity,
+			heatmap_radius,
+			center,
+			st.session_state.get('map_zoom', 2)
+		),
+		height=700
+	)
+else:
+	st.iframe(
+		build_map_html(
+			st.session_state['pred_heat_json'],
+			st.session_state['shark_locs'],
+			heatmap_opacity,
+			heatmap_radius,
+			center,
+			st.session_state.get('map_zoom', 2)
+		),
+		height=700
+	)
 
 
 st.info("Shark locations (red markers) and simulated ocean productivity (heatmap) are shown. Foraging zones can be predicted where productivity is high and sharks are present.")
-